@@ -3,16 +3,38 @@ import datetime
 import uuid
 import time
 import threading
+import atexit
+import traceback
+import queue
 import os
+import re
+import json
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import hashlib
+from collections import OrderedDict, deque
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+_UTC = datetime.timezone.utc
 
 # Optional Databricks imports with fallback
 try:
-    from databricks.sdk import WorkspaceClient
     from databricks import sql
     DATABRICKS_AVAILABLE = True
 except ImportError:
     DATABRICKS_AVAILABLE = False
-    print("Databricks SDK not available. Feedback will be stored locally instead of in database.")
+    print("Databricks SQL connector not available. Feedback will be stored locally instead of in database.")
+
+# Optional fast JSON encoder with stdlib fallback
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 # Alternative database options
 try:
@@ -21,69 +43,580 @@ try:
 except ImportError:
     SQLITE_AVAILABLE = False
 
+@dataclass(slots=True)
+class Msg:
+    """A single chat message held in session state"""
+    role: str
+    content: str
+    html: Optional[str] = None
+    ts: float = 0.0
+    key: str = ''
+
+    def to_dict(self):
+        """Role/content dict in the shape the endpoint and logs expect"""
+        return {'role': self.role, 'content': self.content}
+
+def _history_as_dicts(chat_history):
+    """Convert the chat history to plain dicts for requests and logging"""
+    return [m.to_dict() for m in chat_history]
+
+def _loads_json(data):
+    """Parse JSON from str or bytes"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _dumps_json_bytes(obj):
+    """Serialize an object to compact UTF-8 JSON bytes"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+def _dumps_json(obj):
+    """Serialize an object to a compact JSON string"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+def _encode_new_messages(chat_history, encoded, offset=0):
+    """Append the JSON of messages not yet in ``encoded`` to it
+
+    ``encoded`` holds the JSON of messages already serialized, so each message
+    is encoded once. ``offset`` is the number of messages already evicted from
+    the front of ``chat_history``; they stay in ``encoded`` so the log keeps
+    the whole chat.
+    """
+    for message in islice(chat_history, len(encoded) - offset, None):
+        encoded.append(_dumps_json(message.to_dict()))
+
+def _join_encoded(encoded, prefix=''):
+    """Join already encoded messages, after an already joined prefix, into a JSON array string"""
+    return '[' + ','.join(chain([prefix] if prefix else (), encoded)) + ']'
+
+# Databricks SQL and outbox state owned by the log worker thread. Streamlit re-executes this
+# script on every rerun, but the worker keeps the globals of the run that started it. Only the
+# config is set from the script thread, before the worker starts; everything else is used by
+# the worker alone, so no lock is needed. This state lives here rather than in cache_resource,
+# which needs a ScriptRunContext the worker doesn't have.
+_writer_state = {'config': None, 'conn': None, 'cursor': None, 'outbox': None}
+
+def _sql_config_from_secrets():
+    """Connection settings and target table, read from secrets on the script thread"""
+    return {
+        'server_hostname': st.secrets.get("DATABRICKS_SERVER_HOSTNAME"),
+        'http_path': st.secrets.get("DATABRICKS_HTTP_PATH"),
+        'access_token': st.secrets.get("DATABRICKS_PAT"),
+        'table': st.secrets.get("FEEDBACK_TABLE")
+    }
+
+def _feedback_table():
+    """Fully qualified feedback table name"""
+    return _writer_state['config']['table']
+
+def _get_sql_cursor():
+    """Cursor on the writer's connection, connecting on first use or after the server closed it"""
+    conn = _writer_state['conn']
+    if conn is None or not getattr(conn, 'open', True):
+        _reset_sql()
+        config = _writer_state['config']
+        conn = sql.connect(
+            server_hostname=config['server_hostname'],
+            http_path=config['http_path'],
+            access_token=config['access_token']
+        )
+        _writer_state['conn'] = conn
+        _writer_state['cursor'] = conn.cursor()
+    return _writer_state['cursor']
+
+def _reset_sql():
+    """Close and forget the connection so the next write reconnects"""
+    conn = _writer_state['conn']
+    _writer_state['conn'] = _writer_state['cursor'] = None
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+def _execute_sql(query, params, retries=2):
+    """Run a write on the writer's connection, reconnecting with backoff on failure"""
+    for attempt in range(retries + 1):
+        try:
+            _get_sql_cursor().execute(query, params)
+            _writer_state['conn'].commit()
+            return
+        except Exception:
+            # Drop the connection so the next attempt opens a fresh one
+            _reset_sql()
+            if attempt == retries:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
+
+# Log rows are flushed when this many are queued or this many seconds have passed
+LOG_BATCH_SIZE = 50
+LOG_FLUSH_SECONDS = 2.0
+# Rows parked in the outbox are retried at least this often, even when nothing new is queued
+OUTBOX_RETRY_SECONDS = 60.0
+# Append-only JSONL copies of every feedback row and conversation snapshot, one file per conversation
+LOCAL_LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_logs")
+# SQLite outbox holding rows that failed to reach Databricks until a later flush succeeds
+PENDING_DB_PATH = os.path.join(LOCAL_LOG_DIR, "pending.db")
+
+def _append_local_logs(items):
+    """Append queued rows to their conversation's local JSONL file"""
+    by_file = {}
+    for kind, conversation_id, row in items:
+        if kind == 'conversation':
+            # The local file is append-only, so it gets just the turns added since the last snapshot.
+            # The messages are already encoded, so they are spliced into the line rather than re-dumped
+            head = _dumps_json({
+                'kind': kind,
+                'id': row['id'],
+                'timestamp': row['timestamp'],
+                'comment': row['comment'],
+                'first_index': row['first_index']
+            })
+            delta = _join_encoded(row['encoded'][row['first_index'] - row['prefix_count']:])
+            line = head[:-1] + ',"messages":' + delta + '}'
+        else:
+            line = _dumps_json({'kind': kind, **row})
+        by_file.setdefault(conversation_id or "no_conversation", []).append(line)
+    os.makedirs(LOCAL_LOG_DIR, exist_ok=True)
+    for conversation_id, lines in by_file.items():
+        with open(os.path.join(LOCAL_LOG_DIR, f"{conversation_id}.jsonl"), "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+def _get_pending_db():
+    """WAL-mode SQLite connection for the outbox, or None when sqlite3 is unavailable"""
+    if not SQLITE_AVAILABLE:
+        return None
+    if _writer_state['outbox'] is None:
+        os.makedirs(LOCAL_LOG_DIR, exist_ok=True)
+        # Only the log worker thread touches this connection
+        conn = sqlite3.connect(PENDING_DB_PATH, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS pending_rows
+            (id TEXT PRIMARY KEY, kind TEXT, timestamp TEXT, message TEXT, feedback TEXT, comment TEXT)
+        """)
+        _writer_state['outbox'] = conn
+    return _writer_state['outbox']
+
+def _park_rows(kind, rows):
+    """Keep rows that failed to reach Databricks in the outbox, newest snapshot per id"""
+    try:
+        db = _get_pending_db()
+        if db is not None:
+            db.executemany("INSERT OR REPLACE INTO pending_rows VALUES (?, ?, ?, ?, ?, ?)", [
+                (row['id'], kind, row['timestamp'], row['message'], row['feedback'], row['comment'])
+                for row in rows
+            ])
+    except Exception as e:
+        print(f"⚠️ Could not park rows in the outbox: {e}")
+
+def _load_parked_rows():
+    """Feedback rows and conversation snapshots waiting in the outbox"""
+    parked = {'feedback': [], 'conversation': []}
+    try:
+        db = _get_pending_db()
+        if db is not None:
+            for kind, *values in db.execute(
+                "SELECT kind, id, timestamp, message, feedback, comment FROM pending_rows"
+            ):
+                parked[kind].append(dict(zip(('id', 'timestamp', 'message', 'feedback', 'comment'), values)))
+    except Exception as e:
+        print(f"⚠️ Could not read the outbox: {e}")
+    return parked['feedback'], parked['conversation']
+
+def _unpark_rows(rows):
+    """Drop rows from the outbox once they have been written to Databricks"""
+    if not rows:
+        return
+    try:
+        _get_pending_db().executemany("DELETE FROM pending_rows WHERE id = ?", [(row['id'],) for row in rows])
+    except Exception as e:
+        print(f"⚠️ Could not clear the outbox: {e}")
+
+# The SQL connector binds at most this many parameters per statement, five per row
+MAX_QUERY_PARAMETERS = 256
+MERGE_MAX_ROWS = MAX_QUERY_PARAMETERS // 5
+
+def _merge_source(row_count):
+    """UNION ALL source of ``row_count`` parameterized feedback-table rows"""
+    return " UNION ALL ".join(
+        ["SELECT ? AS id, ? AS timestamp, ? AS message, ? AS feedback, ? AS comment"]
+        + ["SELECT ?, ?, ?, ?, ?"] * (row_count - 1)
+    )
+
+def _merge_params(rows):
+    """Flattened parameters for a ``_merge_source`` of these rows"""
+    return tuple(
+        value
+        for row in rows
+        for value in (row['id'], row['timestamp'], row['message'], row['feedback'], row['comment'])
+    )
+
+def _save_feedback_batch(rows):
+    """Insert feedback rows with one multi-row MERGE per parameter-capped chunk"""
+    try:
+        print(f"🛠️ Storing {len(rows)} feedback row(s)...")
+        for start in range(0, len(rows), MERGE_MAX_ROWS):
+            chunk = rows[start:start + MERGE_MAX_ROWS]
+            # Retries and outbox replays resend rows that may already have landed, so existing ids are skipped
+            _execute_sql(f"""
+                MERGE INTO {_feedback_table()} AS target
+                USING ({_merge_source(len(chunk))}) AS source
+                ON target.id = source.id
+                WHEN NOT MATCHED THEN INSERT (id, timestamp, message, feedback, comment)
+                VALUES (source.id, source.timestamp, source.message, source.feedback, source.comment)
+            """, _merge_params(chunk))
+        print("✅ Feedback committed to database")
+        return True
+    except Exception as e:
+        print(f"⚠️ Could not store feedback: {e}")
+        traceback.print_exc()
+        return False
+
+def _upsert_conversations(rows):
+    """Upsert conversation snapshots into the feedback table, one MERGE per parameter-capped chunk"""
+    try:
+        for start in range(0, len(rows), MERGE_MAX_ROWS):
+            chunk = rows[start:start + MERGE_MAX_ROWS]
+            _execute_sql(f"""
+                MERGE INTO {_feedback_table()} AS target
+                USING ({_merge_source(len(chunk))}) AS source
+                ON target.id = source.id
+                WHEN MATCHED THEN UPDATE SET 
+                    timestamp = source.timestamp, 
+                    message = source.message, 
+                    comment = source.comment
+                WHEN NOT MATCHED THEN INSERT (id, timestamp, message, feedback, comment)
+                VALUES (source.id, source.timestamp, source.message, source.feedback, source.comment)
+            """, _merge_params(chunk))
+        return True
+    except Exception as e:
+        print(f"⚠️ Could not upsert conversation: {e}")
+        traceback.print_exc()
+        return False
+
+def _flush_log_batch(items):
+    """Write a batch to the local JSONL logs, then to Databricks when available
+
+    An empty batch only retries the rows parked in the outbox.
+    """
+    if items:
+        try:
+            _append_local_logs(items)
+        except Exception as e:
+            print(f"⚠️ Could not write local log: {e}")
+    
+    if not DATABRICKS_AVAILABLE:
+        return
+    
+    # Rows parked by earlier failed flushes are retried alongside the new ones
+    parked_feedback, parked_snapshots = _load_parked_rows()
+    
+    feedback_rows = parked_feedback + [row for kind, _, row in items if kind == 'feedback']
+    if feedback_rows:
+        if _save_feedback_batch(feedback_rows):
+            _unpark_rows(parked_feedback)
+        else:
+            _park_rows('feedback', feedback_rows)
+    # Snapshots queued within one flush window are debounced to the newest per conversation
+    latest_snapshots = {}
+    for kind, conversation_id, row in items:
+        if kind == 'conversation':
+            latest_snapshots[conversation_id] = row
+    # Payloads are joined only for the snapshot that will actually be written
+    pending_snapshots = {row['id']: row for row in parked_snapshots}
+    pending_snapshots.update(
+        (conversation_id, {**row, 'message': _join_encoded(row['encoded'], row['prefix'])})
+        for conversation_id, row in latest_snapshots.items()
+    )
+    if pending_snapshots:
+        snapshot_rows = list(pending_snapshots.values())
+        if _upsert_conversations(snapshot_rows):
+            _unpark_rows(parked_snapshots)
+        else:
+            _park_rows('conversation', snapshot_rows)
+
+def _log_worker(log_queue):
+    """Drain the log queue, batching rows by size or flush interval, until it gets a None sentinel"""
+    while True:
+        try:
+            item = log_queue.get(timeout=OUTBOX_RETRY_SECONDS)
+        except queue.Empty:
+            # Idle (or freshly restarted) processes still drain what earlier failures parked
+            _flush_log_batch([])
+            continue
+        if item is None:
+            return
+        items = [item]
+        stopping = False
+        deadline = time.monotonic() + LOG_FLUSH_SECONDS
+        while len(items) < LOG_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = log_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                break
+            items.append(item)
+        _flush_log_batch(items)
+        if stopping:
+            return
+
+# How long process exit waits for the log worker to finish its last flush
+LOG_SHUTDOWN_TIMEOUT = 30.0
+
+def _stop_log_worker(log_queue, worker):
+    """At exit, let the worker flush everything queued before the sentinel, then wait for it"""
+    log_queue.put(None)
+    worker.join(timeout=LOG_SHUTDOWN_TIMEOUT)
+
+@st.cache_resource
+def _get_log_queue():
+    """Process-wide queue of (kind, conversation_id, row) items with its background writer"""
+    log_queue = queue.Queue()
+    _writer_state['config'] = _sql_config_from_secrets()
+    worker = threading.Thread(target=_log_worker, args=(log_queue,), daemon=True)
+    worker.start()
+    # The worker stays the only writer, so rows it already dequeued are flushed rather than lost
+    atexit.register(_stop_log_worker, log_queue, worker)
+    return log_queue
+
+# Replies to short conversations are cached by a hash of the whole history
+RESPONSE_CACHE_SIZE = 256
+RESPONSE_CACHE_MAX_MESSAGES = 8
+# Cached replies expire after this many seconds so prompt or model updates show through
+RESPONSE_CACHE_TTL = 3600
+
+@st.cache_resource
+def _get_response_cache():
+    """Process-wide LRU of (reply, expiry) keyed by conversation hash, with its lock"""
+    return OrderedDict(), threading.Lock()
+
+# Phone numbers and street addresses make a reply job-specific, so those turns are never cached
+# Phones may carry a +1 prefix and a parenthesised area code; street names may run to four words
+_RE_JOB_SPECIFIC = re.compile(
+    r'(?:\+?1[\s.-]?)?(?:\(\d{3}\)|\b\d{3})[\s.-]?\d{3}[\s.-]?\d{4}\b'
+    r'|\b\d+(?:\s+[a-z]+){1,4}\s+'
+    r'(?:st|street|ave|avenue|rd|road|dr|drive|ln|lane|blvd|boulevard|ct|court|way|pl|place)\b',
+    re.IGNORECASE
+)
+
+def _response_cache_key(chat_history):
+    """SHA-256 of the serialized history, or None when it's too long or too job-specific to cache"""
+    if len(chat_history) >= RESPONSE_CACHE_MAX_MESSAGES:
+        return None
+    if any(_RE_JOB_SPECIFIC.search(message.content) for message in chat_history):
+        return None
+    return hashlib.sha256(_dumps_json_bytes(_history_as_dicts(chat_history))).digest()
+
+# Rolling window of the history sent to the model; older turns stay in the log only
+MODEL_CONTEXT_MESSAGES = 12
+MODEL_CONTEXT_CHARS = 8000
+
+def _history_for_model(chat_history, max_msgs=MODEL_CONTEXT_MESSAGES, max_chars=MODEL_CONTEXT_CHARS):
+    """The most recent messages that fit the context budget, oldest first
+
+    The latest message is always kept, even when it alone exceeds ``max_chars``.
+    The window starts on a user turn, as chat templates expect.
+    """
+    window = []
+    total_chars = 0
+    for message in reversed(chat_history):
+        total_chars += len(message.content)
+        if window and (len(window) >= max_msgs or total_chars > max_chars):
+            break
+        window.append(message)
+    # The cut can land mid-turn; drop replies whose prompt fell outside the window
+    while len(window) > 1 and window[-1].role != 'user':
+        window.pop()
+    window.reverse()
+    return window
+
+@st.cache_resource
+def _get_executor():
+    """Worker pool that runs model calls and warmups off the Streamlit script thread"""
+    executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="chat-worker")
+    atexit.register(executor.shutdown, wait=False)
+    return executor
+
+# (connect, read) timeouts for model endpoint calls; the read timeout applies between streamed chunks
+ENDPOINT_TIMEOUT = (5, 60)
+
+@st.cache_resource
+def _get_http_session():
+    """Shared requests session so endpoint calls reuse pooled TLS connections"""
+    session = requests.Session()
+    session.headers.update({"Connection": "keep-alive"})
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        # Sized above the worker pool so concurrent calls never drop a kept-alive socket
+        pool_maxsize=32,
+        pool_block=False,
+        # Retry failed handshakes and gateway errors, but never re-send after a read has started
+        max_retries=Retry(
+            total=2,
+            connect=2,
+            read=0,
+            backoff_factor=0.3,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=frozenset(["HEAD", "POST"])
+        )
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+@st.cache_resource
+def _get_endpoint_url():
+    """Serving endpoint URL, read from secrets once per process"""
+    return st.secrets['ENDPOINT_URL']
+
+# Request fields that are the same on every call to the serving endpoint
+_BASE_PAYLOAD = {"temperature": 0.7}
+
+@st.cache_resource
+def _get_endpoint_headers():
+    """Auth and content-type headers for the serving endpoint, built once per process"""
+    return {
+        "Authorization": f"Bearer {st.secrets['DATABRICKS_PAT']}",
+        "Content-Type": "application/json"
+    }
+
+def _get_endpoint():
+    """(session, url, headers) for the serving endpoint
+
+    Resolved on the script thread and handed to worker threads, which have no
+    ScriptRunContext to look up cache_resource values with.
+    """
+    return _get_http_session(), _get_endpoint_url(), _get_endpoint_headers()
+
+def _warm_endpoint(endpoint):
+    """Open a connection to the serving endpoint ahead of the first user turn"""
+    session, url, _ = endpoint
+    try:
+        session.head(url, timeout=3)
+    except Exception as e:
+        print(f"Endpoint warmup failed: {e}")
+
+def _extract_content(result):
+    """Pull the reply text out of the common endpoint response formats"""
+    if "choices" in result and len(result["choices"]) > 0:
+        return result["choices"][0]["message"]["content"]
+    elif "predictions" in result and len(result["predictions"]) > 0:
+        return result["predictions"][0]
+    elif "content" in result:
+        return result["content"]
+    else:
+        return str(result)
+
+def _iter_sse_data(response):
+    """Yield the raw bytes payload of each SSE data line as it arrives"""
+    buffer = b''
+    for chunk in response.iter_content(chunk_size=None):
+        buffer += chunk
+        while b'\n' in buffer:
+            line, buffer = buffer.split(b'\n', 1)
+            if line.startswith(b'data:'):
+                yield line[5:].strip()
+
+def _iter_sse_deltas(response):
+    """Yield the content delta of each streamed chat completion chunk"""
+    for data in _iter_sse_data(response):
+        if data == b'[DONE]':
+            break
+        choices = _loads_json(data).get('choices') or []
+        if choices:
+            content = (choices[0].get('delta') or {}).get('content')
+            if content:
+                yield content
+
+# Streamed deltas are merged until this many characters or seconds have accumulated
+STREAM_FLUSH_CHARS = 24
+STREAM_FLUSH_SECONDS = 0.016
+
+def _coalesce_deltas(deltas):
+    """Merge tiny streamed deltas into fewer, larger pieces"""
+    pending = []
+    pending_chars = 0
+    last_flush = time.monotonic()
+    for delta in deltas:
+        pending.append(delta)
+        pending_chars += len(delta)
+        now = time.monotonic()
+        if pending_chars >= STREAM_FLUSH_CHARS or now - last_flush >= STREAM_FLUSH_SECONDS:
+            yield ''.join(pending)
+            pending.clear()
+            pending_chars = 0
+            last_flush = now
+    if pending:
+        yield ''.join(pending)
+
 # You'll need to implement this function or replace with your model serving logic
-def query_endpoint(endpoint_name, messages, max_tokens=128):
-    """Query Databricks model serving endpoint - simple version"""
+def stream_endpoint(endpoint_name, messages, endpoint, max_tokens=128):
+    """Stream reply text deltas from the Databricks model serving endpoint"""
+    session, url, headers = endpoint
     try:
-        import requests
-        
-        url = st.secrets['ENDPOINT_URL']
-        
-        headers = {
-            "Authorization": f"Bearer {st.secrets['DATABRICKS_PAT']}",
-            "Content-Type": "application/json"
-        }
-        
         request_data = {
             "messages": messages,
             "max_tokens": max_tokens,
-            "temperature": 0.7
+            "stream": True,
+            **_BASE_PAYLOAD
         }
         
-        response = requests.post(url, headers=headers, json=request_data)
-        response.raise_for_status()
-        
-        result = response.json()
-        
-        # Handle common response formats
-        if "choices" in result and len(result["choices"]) > 0:
-            return {"content": result["choices"][0]["message"]["content"]}
-        elif "predictions" in result and len(result["predictions"]) > 0:
-            return {"content": result["predictions"][0]}
-        elif "content" in result:
-            return {"content": result["content"]}
-        else:
-            return {"content": str(result)}
+        body = _dumps_json_bytes(request_data)
+        with session.post(url, headers=headers, data=body, stream=True, timeout=ENDPOINT_TIMEOUT) as response:
+            response.raise_for_status()
+            
+            # Endpoints that ignore the stream flag answer with a single JSON body
+            if 'text/event-stream' not in response.headers.get('Content-Type', ''):
+                yield _extract_content(_loads_json(response.content))
+                return
+            
+            yield from _coalesce_deltas(_iter_sse_deltas(response))
             
     except Exception as e:
         raise Exception(f"Model endpoint error: {str(e)}")
 
-class StreamlitChatbot:
-    def __init__(self, endpoint_name):
-        self.endpoint_name = endpoint_name
-        self._initialize_session_state()
-        self._add_custom_css()
-    
-    def _initialize_session_state(self):
-        """Initialize all session state variables"""
-        if 'chat_history' not in st.session_state:
-            st.session_state.chat_history = []
-        if 'feedback_selection' not in st.session_state:
-            st.session_state.feedback_selection = {}
-        if 'feedback_comments' not in st.session_state:
-            st.session_state.feedback_comments = {}
-        if 'feedback_submitted' not in st.session_state:
-            st.session_state.feedback_submitted = set()
-        if 'input_key_counter' not in st.session_state:
-            st.session_state.input_key_counter = 0
-        if 'conversation_log_id' not in st.session_state:
-            st.session_state.conversation_log_id = None
-        if 'response_count' not in st.session_state:
-            st.session_state.response_count = 0
-    
-    def _add_custom_css(self):
-        """Add custom CSS styling"""
-        st.markdown("""
+# Single-pass translation table for escaping message text before it is wrapped in HTML
+_HTML_ESCAPE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;'})
+
+def _escape_html(text):
+    """Escape HTML special characters in one C-level pass"""
+    return text.translate(_HTML_ESCAPE)
+
+_BULLET_INDENT = '&nbsp;' * 4
+_SUB_BULLET_INDENT = '&nbsp;' * 8
+
+def _indent_bullet(line):
+    """Indent a line of an assistant reply according to its bullet level"""
+    # Plain text lines (the common case) can't be bullets; skip the strip/startswith work
+    first = line[:1]
+    if first not in ('-', '–') and not first.isspace():
+        return line
+    # Sub-bullet (2 spaces before dash), add more indentation
+    if line.startswith(('  -', '  –')):
+        return _SUB_BULLET_INDENT + line.strip()
+    # Top-level bullet, standard indent
+    stripped = line.strip()
+    if stripped.startswith(('-', '–')):
+        return _BULLET_INDENT + stripped
+    # Regular text, no indent
+    return line
+
+# URLs in assistant replies are turned into links
+_RE_URL = re.compile(r'(https?://[^\s<]+)')
+_URL_LINK = r'<a href="\1" target="_blank" style="color: #66B3FF; text-decoration: underline;">\1</a>'
+
+CUSTOM_CSS = """
         <style>
         @import url('https://fonts.googleapis.com/css2?family=DM+Sans:wght@400;500;700&display=swap');
         
@@ -199,14 +732,6 @@ class StreamlitChatbot:
             margin-right: auto;
         }
         
-        .feedback-container {
-            margin-top: 15px;
-            padding: 15px;
-            background-color: transparent;
-            border-radius: 10px;
-            font-size: 16px;
-        }
-        
         .feedback-thankyou {
             color: #00A972;
             font-weight: bold;
@@ -222,19 +747,6 @@ class StreamlitChatbot:
             padding: 0.35rem 0.75rem !important;
         }
         
-        /* FIXED INPUT BAR - absolutely positioned at bottom */
-        .fixed-input-section {
-            position: fixed;
-            bottom: 0;
-            left: 0;
-            right: 0;
-            background-color: #F9F7F4;
-            padding: 15px 20px;
-            border-top: 2px solid #EEEDE9;
-            z-index: 1000;
-            box-shadow: 0 -4px 12px rgba(0,0,0,0.1);
-        }
-        
         .stChatInput input {
             font-size: 18px !important;
             font-family: 'DM Sans', sans-serif;
@@ -254,248 +766,395 @@ class StreamlitChatbot:
             transition: background-color 0.2s ease;
         }
         </style>
-        """, unsafe_allow_html=True)
+        """
+
+@st.cache_resource
+def _get_custom_css():
+    """CUSTOM_CSS with whitespace collapsed, computed once per process rather than every rerun"""
+    return " ".join(CUSTOM_CSS.split())
+
+@st.cache_resource
+def _get_header_html():
+    """Fixed header with the page title, built from secrets once per process"""
+    return f'''
+        <div class="fixed-header-section">
+            <h2 class="chat-title">{st.secrets['PAGE_TITLE']}</h2>
+            <div style="display: flex; gap: 10px; align-items: center; justify-content: center;">
+                <div class="info-note" style="width: 600px;">
+                    💬 Ask the rep below for handyman job information and estimates.
+                </div>
+                <button id="new-chat-btn"
+                    style="padding: 0.35rem 0.75rem; background-color: white;
+                           border: 1px solid #ddd; border-radius: 20px;
+                           font-size: 16px; font-family: 'DM Sans', sans-serif;
+                           cursor: pointer; white-space: nowrap;">
+                    New Chat
+                </button>
+            </div>
+        </div>
+        <div style="height: 100px;"></div>
+        '''
+
+# Number of most recent messages rendered per rerun
+HISTORY_WINDOW = 50
+# Maximum number of messages kept live in session state; older ones survive only in the log
+MAX_HISTORY = 2000
+# Maximum number of formatted message blocks kept in the render cache
+RENDER_CACHE_SIZE = 500
+
+def _build_message_html(role, content):
+    """Build the styled HTML block for a single message"""
+    content = _escape_html(content)
+    if role == 'user':
+        # User text has no bullets or links to format; only line breaks are kept
+        content = content.replace('\n', '<br>')
+        return f"""
+        <div class="chat-message user-message">
+            {content}
+        </div>
+        """
+
+    formatted_content = '<br>'.join([_indent_bullet(line) for line in content.split('\n')])
+
+    # Convert URLs to clickable links (cheap substring check skips the regex for plain replies)
+    if 'http' in formatted_content:
+        formatted_content = _RE_URL.sub(_URL_LINK, formatted_content)
+
+    return f"""
+        <div class="chat-message assistant-message">
+            {formatted_content}
+        </div>
+        """
+
+# Feedback votes, stored per message as (vote, submitted) in one list indexed by message position
+FEEDBACK_NONE, FEEDBACK_UP, FEEDBACK_DOWN = 0, 1, 2
+# Value written to the feedback table for each vote
+FEEDBACK_VALUES = ('none', 'thumbs-up', 'thumbs-down')
+
+@st.cache_data(max_entries=RENDER_CACHE_SIZE, show_spinner=False)
+def _cached_message_html(role, content):
+    """Formatted message HTML, memoized across reruns and sessions by (role, content)"""
+    return _build_message_html(role, content)
+
+class StreamlitChatbot:
+    def __init__(self, endpoint_name):
+        # Instances are shared across sessions (see get_chatbot), so no per-user state lives here
+        self.endpoint_name = endpoint_name
+    
+    def _initialize_session_state(self):
+        """Initialize all session state variables"""
+        if 'chat_history' not in st.session_state:
+            st.session_state.chat_history = deque(maxlen=MAX_HISTORY)
+            st.session_state.history_offset = 0
+        if 'feedback' not in st.session_state:
+            st.session_state.feedback = []
+        if 'input_key_counter' not in st.session_state:
+            st.session_state.input_key_counter = 0
+            st.session_state._chat_input_key = "chat_input_0"
+        if 'conversation_log_id' not in st.session_state:
+            st.session_state.conversation_log_id = None
+        if 'response_count' not in st.session_state:
+            st.session_state.response_count = 0
+        if '_encoded_history' not in st.session_state:
+            st.session_state._encoded_history = []
+            st.session_state._log_prefix = ''
+            st.session_state._log_prefix_count = 0
+        if 'pending_reply' not in st.session_state:
+            st.session_state.pending_reply = None
     
-    def _call_model_endpoint(self, messages, max_tokens=128):
-        """Call the model endpoint with error handling"""
+    def _add_custom_css(self):
+        """Add custom CSS styling"""
+        # Streamlit drops elements a rerun doesn't re-emit, so the style block is sent every run
+        st.markdown(_get_custom_css(), unsafe_allow_html=True)
+    
+    def _stream_model_endpoint(self, messages, endpoint, max_tokens=128):
+        """Stream the model reply with error handling"""
         try:
-            print('Calling model endpoint...')
-            return query_endpoint(self.endpoint_name, messages, max_tokens)["content"]
+            print('Streaming from model endpoint...')
+            yield from stream_endpoint(self.endpoint_name, _history_as_dicts(messages), endpoint, max_tokens)
         except Exception as e:
             print(f'Error calling model endpoint: {str(e)}')
             raise
     
-    def _save_feedback_to_database(self, feedback_data):
-        """Save feedback to database - simple version"""
-        def insert_feedback():
-            try:
-                print("🛠️ Storing feedback...")
-                from databricks import sql
-                
-                conn = sql.connect(
-                    server_hostname=st.secrets["DATABRICKS_SERVER_HOSTNAME"],
-                    http_path=st.secrets["DATABRICKS_HTTP_PATH"],
-                    access_token=st.secrets["DATABRICKS_PAT"]
-                )
-                
-                cursor = conn.cursor()
-                cursor.execute("SELECT 1 as test")
-                result = cursor.fetchone()
-                
-                cursor.execute(f"""
-                    INSERT INTO {st.secrets['FEEDBACK_TABLE']}
-                    (id, timestamp, message, feedback, comment)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (
-                    feedback_data['id'],
-                    feedback_data['timestamp'],
-                    feedback_data['message'],
-                    feedback_data['feedback'],
-                    feedback_data['comment']
-                ))
-                
-                conn.commit()
-                cursor.close()
-                conn.close()
-                print("✅ Feedback committed to database")
-                
-            except Exception as e:
-                import traceback
-                print(f"⚠️ Could not store feedback: {e}")
-                traceback.print_exc()
+    def _collect_reply(self, messages, chunks, endpoint, response_cache):
+        """Consume the reply stream on a worker thread, exposing partial text through chunks"""
+        cache, lock = response_cache
+        key = _response_cache_key(messages)
+        if key is not None:
+            with lock:
+                cached = None
+                entry = cache.get(key)
+                if entry is not None:
+                    if entry[1] > time.monotonic():
+                        cached = entry[0]
+                        cache.move_to_end(key)
+                    else:
+                        del cache[key]
+            if cached is not None:
+                chunks.append(cached)
+                return cached
         
-        threading.Thread(target=insert_feedback).start()
-
-    def _save_conversation_log(self):
-        """Upsert the entire chat history to the same feedback table"""
-        def upsert_conversation(chat_history, conversation_id, response_count):
-            try:
-                from databricks import sql
-                
-                conn = sql.connect(
-                    server_hostname=st.secrets["DATABRICKS_SERVER_HOSTNAME"],
-                    http_path=st.secrets["DATABRICKS_HTTP_PATH"],
-                    access_token=st.secrets["DATABRICKS_PAT"]
-                )
-                cursor = conn.cursor()
+        for chunk in self._stream_model_endpoint(messages, endpoint):
+            chunks.append(chunk)
+        reply = ''.join(chunks)
+        
+        if key is not None:
+            with lock:
+                cache[key] = (reply, time.monotonic() + RESPONSE_CACHE_TTL)
+                if len(cache) > RESPONSE_CACHE_SIZE:
+                    cache.popitem(last=False)
+        return reply
     
-                cursor.execute(f"""
-                    MERGE INTO {st.secrets['FEEDBACK_TABLE']} AS target
-                    USING (SELECT ? AS id) AS source
-                    ON target.id = source.id
-                    WHEN MATCHED THEN UPDATE SET 
-                        timestamp = ?, 
-                        message = ?, 
-                        comment = ?
-                    WHEN NOT MATCHED THEN INSERT (id, timestamp, message, feedback, comment)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (
-                    conversation_id,
-                    datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                    str(chat_history),
-                    f"Reponse(s): {response_count}",
-                    conversation_id,
-                    datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                    str(chat_history),
-                    "Conversation_Log",
-                    f"Reponse(s): {response_count}"
-                ))
+    def _start_assistant_reply(self):
+        """Submit the model call to the worker pool so the script thread stays free"""
+        chunks = []
+        # Cached resources are looked up here; the worker thread can't reach Streamlit's caches
+        future = _get_executor().submit(
+            self._collect_reply, _history_for_model(st.session_state.chat_history), chunks,
+            _get_endpoint(), _get_response_cache()
+        )
+        st.session_state.pending_reply = {'future': future, 'chunks': chunks}
     
-                conn.commit()
-                cursor.close()
-                conn.close()
+    @st.fragment(run_every=0.2)
+    def _render_pending_reply(self):
+        """Poll the in-flight model call, showing partial text until it completes"""
+        pending = st.session_state.get('pending_reply')
+        if pending is None:
+            return
+        
+        future = pending['future']
+        if not future.done():
+            partial = ''.join(pending['chunks']) or 'Thinking...'
+            st.markdown(_build_message_html('assistant', partial), unsafe_allow_html=True)
+            return
+        
+        try:
+            assistant_response = future.result()
+        except Exception as e:
+            assistant_response = f'Error: {str(e)}'
+        
+        # One append and one save per turn, whether the call succeeded or failed
+        st.session_state.pending_reply = None
+        self._append_message('assistant', assistant_response)
+        try:
+            self._save_conversation_log()
+        except Exception as e:
+            print(f"⚠️ Could not queue conversation log: {e}")
+            traceback.print_exc()
+        st.rerun()
     
-            except Exception as e:
-                import traceback
-                print(f"⚠️ Could not upsert conversation: {e}")
-                traceback.print_exc()
+    def _append_message(self, role, content):
+        """Append a message to the history, stamping its time and widget key once"""
+        history = st.session_state.chat_history
+        # Position in the whole conversation, taken before eviction shifts the offset
+        index = st.session_state.history_offset + len(history)
+        if len(history) == history.maxlen:
+            # Encode the oldest message into the durable log copy before the deque drops it
+            _encode_new_messages(
+                history, st.session_state._encoded_history,
+                st.session_state.history_offset - st.session_state._log_prefix_count
+            )
+            st.session_state.history_offset += 1
+        message = Msg(role=role, content=content, ts=time.time(), key=f"msg_{index}")
+        history.append(message)
+        return message
+    
+    def _submit_user_input(self):
+        """Queue the submitted message and its model call (the chat input's on_submit callback)"""
+        user_input = st.session_state.get(st.session_state._chat_input_key)
+        if user_input and user_input.strip():
+            self._append_message('user', user_input.strip())
+            self._bump_input_key()
+            self._start_assistant_reply()
+    
+    def _bump_input_key(self):
+        """Move the chat input to a fresh widget key so it starts empty"""
+        st.session_state.input_key_counter += 1
+        st.session_state._chat_input_key = f"chat_input_{st.session_state.input_key_counter}"
+    
+    def _save_feedback_to_database(self, feedback_data):
+        """Queue feedback for the background batch writer"""
+        _get_log_queue().put(('feedback', st.session_state.conversation_log_id, feedback_data))
+
+    def _save_conversation_log(self):
+        """Queue an upsert of the entire chat history to the same feedback table"""
+        history = st.session_state.chat_history
+        # The history is append-only, so an unchanged message count means nothing new to log
+        message_count = st.session_state.history_offset + len(history)
+        first_index = st.session_state.get('_last_logged_count', 0)
+        if message_count == first_index:
+            return
 
         if st.session_state.conversation_log_id is None:
             st.session_state.conversation_log_id = str(uuid.uuid4())
 
+        encoded = st.session_state._encoded_history
+        prefix_count = st.session_state._log_prefix_count
+        _encode_new_messages(history, encoded, st.session_state.history_offset - prefix_count)
         st.session_state.response_count += 1
-        threading.Thread(target=upsert_conversation, args=(st.session_state.chat_history, st.session_state.conversation_log_id, st.session_state.response_count)).start()
+        st.session_state._last_logged_count = prefix_count + len(encoded)
+        conversation_id = st.session_state.conversation_log_id
+        # Only a reference copy is taken here; the log worker joins it into the payload
+        _get_log_queue().put(('conversation', conversation_id, {
+            'id': conversation_id,
+            'timestamp': datetime.datetime.now(_UTC).isoformat(),
+            'prefix': st.session_state._log_prefix,
+            'prefix_count': prefix_count,
+            'encoded': tuple(encoded),
+            'feedback': "Conversation_Log",
+            'comment': f"Reponse(s): {st.session_state.response_count}",
+            'first_index': first_index
+        }))
+        # Messages evicted from the deque are now queued, so fold them into one joined string
+        evicted = st.session_state.history_offset - prefix_count
+        if evicted > 0:
+            st.session_state._log_prefix = ','.join(chain(
+                [st.session_state._log_prefix] if st.session_state._log_prefix else (), encoded[:evicted]
+            ))
+            del encoded[:evicted]
+            st.session_state._log_prefix_count = st.session_state.history_offset
     
-    def _render_message(self, message, index):
-        """Render a single message with appropriate styling"""
-        if message['role'] == 'user':
-            st.markdown(f"""
-            <div class="chat-message user-message">
-                {message['content']}
-            </div>
-            """, unsafe_allow_html=True)
-        else:
-            lines = message['content'].split('\n')
-            formatted_lines = []
-            
-            for line in lines:
-                # Check if line starts with spaces followed by a dash
-                if line.startswith('  -') or line.startswith('  –'):
-                    # Sub-bullet (2 spaces before dash), add more indentation
-                    formatted_lines.append('&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;' + line.strip())
-                elif line.strip().startswith('-') or line.strip().startswith('–'):
-                    # Top-level bullet, standard indent
-                    formatted_lines.append('&nbsp;&nbsp;&nbsp;&nbsp;' + line.strip())
-                else:
-                    # Regular text, no indent
-                    formatted_lines.append(line)
-            
-            formatted_content = '<br>'.join(formatted_lines)
-            
-            # Convert URLs to clickable links
-            import re
-            url_pattern = r'(https?://[^\s<]+)'
-            formatted_content = re.sub(url_pattern, r'<a href="\1" target="_blank" style="color: #66B3FF; text-decoration: underline;">\1</a>', formatted_content)
-            
-            st.markdown(f"""
-            <div class="chat-message assistant-message">
-                {formatted_content}
-            </div>
-            """, unsafe_allow_html=True)
-            
-            if index == len(st.session_state.chat_history) - 1:
-                self._render_feedback_ui(index)
+    def _message_html(self, message):
+        """Styled HTML for a message, built once and kept on the message"""
+        # Messages are immutable once appended, so the HTML is built once and reused on every rerun
+        if message.html is None:
+            if message.role == 'user':
+                # Cheap enough to build directly; skips cache_data's hashing and copy
+                message.html = _build_message_html(message.role, message.content)
+            else:
+                message.html = _cached_message_html(message.role, message.content)
+        return message.html
+    
+    def _render_messages(self, history, start):
+        """Render the visible messages as a single markdown element, with feedback under the last reply"""
+        st.markdown('\n'.join(self._message_html(message) for message in islice(history, start, None)),
+                    unsafe_allow_html=True)
+        
+        last = history[-1]
+        if last.role == 'assistant':
+            # Feedback is keyed by position in the whole conversation, which survives eviction
+            self._render_feedback_ui(st.session_state.history_offset + len(history) - 1, last.key)
     
-    def _render_feedback_ui(self, message_index):
-        """Render feedback buttons and form"""
-        if message_index in st.session_state.feedback_submitted:
+    def _get_feedback(self, message_index):
+        """(vote, submitted) for a message, defaulting to no vote"""
+        feedback = st.session_state.feedback
+        if message_index < len(feedback):
+            return feedback[message_index]
+        return (FEEDBACK_NONE, False)
+    
+    def _set_feedback(self, message_index, vote, submitted=False):
+        """Record the vote for a message, growing the list to reach its index"""
+        feedback = st.session_state.feedback
+        if message_index >= len(feedback):
+            feedback.extend([(FEEDBACK_NONE, False)] * (message_index + 1 - len(feedback)))
+        feedback[message_index] = (vote, submitted)
+    
+    @st.fragment
+    def _render_feedback_ui(self, message_index, key):
+        """Render feedback buttons and form as a fragment so clicks only rerun this block"""
+        if self._get_feedback(message_index)[1]:
             st.markdown('<div class="feedback-thankyou">Thank you for the feedback!</div>', 
                        unsafe_allow_html=True)
             return
         
-        st.markdown('<div class="feedback-container">', unsafe_allow_html=True)
+        error = st.session_state.pop('_feedback_error', None)
+        if error:
+            st.error(error)
         
+        # Widgets act through on_click callbacks, which run before the fragment's own rerun,
+        # so no click needs a second explicit st.rerun()
         col1, col2, col3 = st.columns([1, 1, 6])
         
         with col1:
-            if st.button("👍", key=f"thumbs_up_{message_index}", help="Good response"):
-                st.session_state.feedback_selection[str(message_index)] = 'thumbs-up'
-                st.rerun()
+            st.button("👍", key=key + "_up", help="Good response",
+                      on_click=self._set_feedback, args=(message_index, FEEDBACK_UP))
         
         with col2:
-            if st.button("👎", key=f"thumbs_down_{message_index}", help="Poor response"):
-                st.session_state.feedback_selection[str(message_index)] = 'thumbs-down'
-                st.rerun()
+            st.button("👎", key=key + "_down", help="Poor response",
+                      on_click=self._set_feedback, args=(message_index, FEEDBACK_DOWN))
         
-        selected_feedback = st.session_state.feedback_selection.get(str(message_index))
-        if selected_feedback:
-            feedback_text = "👍 Positive" if selected_feedback == 'thumbs-up' else "👎 Negative"
+        selected_feedback = self._get_feedback(message_index)[0]
+        if selected_feedback != FEEDBACK_NONE:
+            feedback_text = "👍 Positive" if selected_feedback == FEEDBACK_UP else "👎 Negative"
             st.write(f"Selected: {feedback_text}")
             
-            comment = st.text_area(
+            st.text_area(
                 "Optional comment:",
-                key=f"comment_{message_index}",
+                key=key + "_comment",
                 height=60,
                 placeholder="Share your thoughts about this response..."
             )
             
-            if st.button("Submit Feedback", key=f"submit_{message_index}", type="primary"):
-                self._handle_feedback_submission(message_index, comment)
-        
-        st.markdown('</div>', unsafe_allow_html=True)
+            st.button("Submit Feedback", key=key + "_submit", type="primary",
+                      on_click=self._handle_feedback_submission, args=(message_index, key + "_comment"))
     
-    def _handle_feedback_submission(self, message_index, comment):
-        """Handle feedback submission"""
+    def _handle_feedback_submission(self, message_index, comment_key):
+        """Handle feedback submission (a Submit button callback)"""
         try:
-            feedback_value = st.session_state.feedback_selection.get(str(message_index), 'none')
+            vote = self._get_feedback(message_index)[0]
+            history = st.session_state.chat_history
+            position = message_index - st.session_state.history_offset
+            # The prompt that produced the reply, if it is still in the live history
+            prompt = history[position - 1].content if position > 0 else None
             
             feedback_data = {
                 'id': str(uuid.uuid4()),
-                'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                'message': str(st.session_state.chat_history),
-                'feedback': feedback_value,
-                'comment': comment
+                'timestamp': datetime.datetime.now(_UTC).isoformat(),
+                # Only the rated exchange is stored; the full history lives in the conversation log row
+                'message': _dumps_json({
+                    'index': message_index,
+                    'prompt': prompt,
+                    'content': history[position].content,
+                    'conversation_log_id': st.session_state.get('conversation_log_id')
+                }),
+                'feedback': FEEDBACK_VALUES[vote],
+                'comment': st.session_state.get(comment_key, '')
             }
             
             self._save_feedback_to_database(feedback_data)
-            st.session_state.feedback_submitted.add(message_index)
-            st.success("Thank you for your feedback!")
-            st.rerun()
+            self._set_feedback(message_index, vote, submitted=True)
             
         except Exception as e:
-            st.error(f"Failed to submit feedback: {str(e)}")
+            # Elements can't be drawn from a callback; the fragment shows this on its next run
+            st.session_state._feedback_error = f"Failed to submit feedback: {str(e)}"
             print(f"Feedback submission error: {e}")
     
     def _clear_chat(self):
         """Clear the chat history"""
-        st.session_state.chat_history = []
-        st.session_state.feedback_selection = {}
-        st.session_state.feedback_comments = {}
-        st.session_state.feedback_submitted = set()
+        st.session_state.chat_history = deque(maxlen=MAX_HISTORY)
+        st.session_state.history_offset = 0
+        st.session_state.feedback = []
         st.session_state.conversation_log_id = None
-        st.session_state.input_key_counter += 1
+        self._bump_input_key()
         st.session_state.response_count = 0
+        st.session_state.pop('history_window_start', None)
+        st.session_state.pop('_last_logged_count', None)
+        st.session_state._encoded_history = []
+        st.session_state._log_prefix = ''
+        st.session_state._log_prefix_count = 0
+        # Any in-flight reply belongs to the old conversation; its result is discarded
+        st.session_state.pending_reply = None
         st.rerun()
+
+    def _load_earlier_messages(self, start):
+        """Widen the rendered history window by one page"""
+        st.session_state.history_window_start = max(0, start - HISTORY_WINDOW)
     
     def render(self):
         """Main render method"""
+        self._initialize_session_state()
+        self._add_custom_css()
+        if not st.session_state.get('_warmed'):
+            _get_executor().submit(_warm_endpoint, _get_endpoint())
+            st.session_state._warmed = True
     
         # If the hidden Streamlit trigger was clicked in the last run, clear now (same logic you had)
         if st.session_state.get('trigger_clear', False):
             st.session_state.trigger_clear = False
             self._clear_chat()
     
-        # ---- FIXED HEADER with pure HTML button (unchanged look/placement) ----
-        st.markdown(f'''
-        <div class="fixed-header-section">
-            <h2 class="chat-title">{st.secrets['PAGE_TITLE']}</h2>
-            <div style="display: flex; gap: 10px; align-items: center; justify-content: center;">
-                <div class="info-note" style="width: 600px;">
-                    💬 Ask the rep below for handyman job information and estimates.
-                </div>
-                <button id="new-chat-btn"
-                    style="padding: 0.35rem 0.75rem; background-color: white;
-                           border: 1px solid #ddd; border-radius: 20px;
-                           font-size: 16px; font-family: 'DM Sans', sans-serif;
-                           cursor: pointer; white-space: nowrap;">
-                    New Chat
-                </button>
-            </div>
-        </div>
-        ''', unsafe_allow_html=True)
-    
-        # Reduced spacer to bring chat content closer to header
-        st.markdown('<div style="height: 100px;"></div>', unsafe_allow_html=True)
+        # ---- FIXED HEADER with pure HTML button, plus the spacer that brings chat content closer ----
+        st.markdown(_get_header_html(), unsafe_allow_html=True)
     
         # ---- HIDDEN Streamlit button ----
         clear_trigger = st.button("trigger_clear_action", key="_hidden_clear_btn")
@@ -523,7 +1182,18 @@ class StreamlitChatbot:
             st.session_state.trigger_clear = True
             st.rerun()
     
-        # ---- Chat content (unchanged) ----
+        # ---- Fixed input bar ----
+        # st.chat_input pins itself to the bottom; separate markdown calls can't wrap a widget in a div.
+        # The submit is handled in on_submit, which runs before this widget is drawn, so the input
+        # already has its fresh key and is disabled while the reply is in flight.
+        st.chat_input(
+            placeholder="Type your message here... (Press Enter to send)",
+            key=st.session_state._chat_input_key,
+            disabled=st.session_state.pending_reply is not None,
+            on_submit=self._submit_user_input
+        )
+    
+        # ---- Chat content ----
         with st.container():
             if len(st.session_state.chat_history) == 0:
                 st.markdown('''
@@ -532,16 +1202,15 @@ class StreamlitChatbot:
                     </div>
                 ''', unsafe_allow_html=True)
             else:
-                for i, message in enumerate(st.session_state.chat_history):
-                    self._render_message(message, i)
-    
-        # ---- Fixed input bar (unchanged) ----
-        st.markdown('<div class="fixed-input-section">', unsafe_allow_html=True)
-        user_input = st.chat_input(
-            placeholder="Type your message here... (Press Enter to send)",
-            key=f"chat_input_{st.session_state.input_key_counter}"
-        )
-        st.markdown('</div>', unsafe_allow_html=True)
+                # Only render the most recent window of messages; older ones load on demand
+                history = st.session_state.chat_history
+                start = st.session_state.get('history_window_start', max(0, len(history) - HISTORY_WINDOW))
+                if start > 0:
+                    st.button("Load earlier messages", key="_load_earlier_btn",
+                              on_click=self._load_earlier_messages, args=(start,))
+                self._render_messages(history, start)
+                if st.session_state.pending_reply is not None:
+                    self._render_pending_reply()
     
         # ---- JS: Attach event listener after page loads ----
         st.components.v1.html("""
@@ -573,22 +1242,11 @@ class StreamlitChatbot:
           setTimeout(attachListener, 1000);
         </script>
         """, height=0)
-    
-        # ---- Handle user input (unchanged) ----
-        if user_input and user_input.strip():
-            st.session_state.chat_history.append({'role': 'user', 'content': user_input.strip()})
-            st.session_state.input_key_counter += 1
-    
-            with st.spinner("Thinking..."):
-                try:
-                    assistant_response = self._call_model_endpoint(st.session_state.chat_history)
-                    st.session_state.chat_history.append({'role': 'assistant', 'content': assistant_response})
-                    self._save_conversation_log()
-                except Exception as e:
-                    st.session_state.chat_history.append({'role': 'assistant', 'content': f'Error: {str(e)}'})
-                    self._save_conversation_log()
-    
-            st.rerun()
+
+@st.cache_resource
+def get_chatbot(endpoint_name):
+    """One chatbot instance per endpoint, reused across reruns and sessions"""
+    return StreamlitChatbot(endpoint_name)
 
 def main():
     st.set_page_config(
@@ -599,20 +1257,23 @@ def main():
     )
     
     endpoint_name = st.secrets.get("DATABRICKS_ENDPOINT_NAME", "your_endpoint_name")
-    chatbot = StreamlitChatbot(endpoint_name)
+    chatbot = get_chatbot(endpoint_name)
     chatbot.render()
 
+SETUP_INSTALL_CMD = """pip install streamlit databricks-sql-connector"""
+SETUP_ENV_VARS = """
+DATABRICKS_SERVER_HOSTNAME=your_hostname
+DATABRICKS_HTTP_PATH=your_http_path  
+DATABRICKS_ACCESS_TOKEN=your_token
+        """
+
 def show_setup_instructions():
     with st.sidebar:
         st.header("Setup Instructions")
         st.subheader("1. Install Dependencies")
-        st.code("""pip install streamlit databricks-sdk databricks-sql-connector""")
+        st.code(SETUP_INSTALL_CMD)
         st.subheader("2. Environment Variables")
-        st.code("""
-DATABRICKS_SERVER_HOSTNAME=your_hostname
-DATABRICKS_HTTP_PATH=your_http_path  
-DATABRICKS_ACCESS_TOKEN=your_token
-        """)
+        st.code(SETUP_ENV_VARS)
 
 if __name__ == "__main__":
     show_setup_instructions()
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("streamlit")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_v2  # noqa: E402
+
+
+def _chat(*contents):
+    """Alternating user/assistant messages, starting with a user turn"""
+    return [
+        app_v2.Msg(role='user' if i % 2 == 0 else 'assistant', content=content)
+        for i, content in enumerate(contents)
+    ]
+
+
+def test_count_limit_keeps_window_on_a_user_turn():
+    history = _chat(*[f"m{i}" for i in range(13)])
+    window = app_v2._history_for_model(history, max_msgs=12)
+    assert window[0].role == 'user'
+    assert window[-1] is history[-1]
+    assert len(window) == 11
+
+
+def test_char_limit_keeps_window_on_a_user_turn():
+    history = _chat("a" * 3000, "b" * 3000, "c" * 3000)
+    window = app_v2._history_for_model(history, max_chars=8000)
+    assert [m.role for m in window] == ['user']
+    assert window[0] is history[-1]
+
+
+def test_short_history_is_sent_whole():
+    history = _chat("hi", "hello", "how much?")
+    assert app_v2._history_for_model(history) == history
+
+
+def test_oversized_latest_message_is_still_sent():
+    history = _chat("x" * 9000)
+    assert app_v2._history_for_model(history, max_chars=8000) == history
@@ -0,0 +1,160 @@
+import os
+import queue
+import sys
+import types
+
+import pytest
+
+pytest.importorskip("streamlit")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_v2  # noqa: E402
+
+
+class _FakeWarehouse:
+    """In-memory stand-in for the feedback table behind ``databricks.sql``"""
+
+    def __init__(self):
+        self.rows = {}
+        self.statements = []
+        self.down = False
+
+    def connect(self, **kwargs):
+        return _FakeConnection(self)
+
+    def execute(self, query, params):
+        if self.down:
+            raise RuntimeError("warehouse unavailable")
+        self.statements.append((query, params))
+        upsert = "WHEN MATCHED" in query
+        for start in range(0, len(params), 5):
+            row_id, timestamp, message, feedback, comment = params[start:start + 5]
+            if upsert or row_id not in self.rows:
+                self.rows[row_id] = {
+                    'timestamp': timestamp, 'message': message, 'feedback': feedback, 'comment': comment
+                }
+
+
+class _FakeCursor:
+    def __init__(self, warehouse):
+        self.warehouse = warehouse
+
+    def execute(self, query, params=None):
+        self.warehouse.execute(query, params)
+
+
+class _FakeConnection:
+    open = True
+
+    def __init__(self, warehouse):
+        self.warehouse = warehouse
+
+    def cursor(self):
+        return _FakeCursor(self.warehouse)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.open = False
+
+
+@pytest.fixture
+def warehouse(tmp_path, monkeypatch):
+    fake = _FakeWarehouse()
+    module = types.ModuleType("databricks.sql")
+    module.connect = fake.connect
+    monkeypatch.setitem(sys.modules, "databricks.sql", module)
+    # app_v2 may already be imported without the connector, so its binding is pointed at the fake too
+    monkeypatch.setattr(app_v2, "sql", module, raising=False)
+    monkeypatch.setattr(app_v2, "DATABRICKS_AVAILABLE", True)
+    monkeypatch.setattr(app_v2, "LOCAL_LOG_DIR", str(tmp_path))
+    monkeypatch.setattr(app_v2, "PENDING_DB_PATH", str(tmp_path / "pending.db"))
+    monkeypatch.setattr(app_v2.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(app_v2, "_writer_state", {
+        'config': {'server_hostname': "host", 'http_path': "path", 'access_token': "token", 'table': "feedback"},
+        'conn': None, 'cursor': None, 'outbox': None
+    })
+    yield fake
+    if app_v2._writer_state['outbox'] is not None:
+        app_v2._writer_state['outbox'].close()
+
+
+def _feedback(row_id):
+    return ('feedback', "conversation", {
+        'id': row_id, 'timestamp': "2026-01-01T00:00:00+00:00", 'message': "{}", 'feedback': "UP", 'comment': ""
+    })
+
+
+def _snapshot(conversation_id, *contents):
+    encoded = tuple(app_v2._dumps_json({'role': 'user', 'content': content}) for content in contents)
+    return ('conversation', conversation_id, {
+        'id': conversation_id, 'timestamp': "2026-01-01T00:00:00+00:00", 'prefix': "", 'prefix_count': 0,
+        'encoded': encoded, 'feedback': "Conversation_Log", 'comment': "Reponse(s): 1", 'first_index': 0
+    })
+
+
+def _contents(message):
+    return [m['content'] for m in app_v2._loads_json(message)]
+
+
+def _parked_ids():
+    return sorted(row['id'] for rows in app_v2._load_parked_rows() for row in rows)
+
+
+def test_merge_chunks_stay_under_parameter_cap(warehouse):
+    app_v2._flush_log_batch([_feedback(f"fb{i}") for i in range(119)])
+    assert [len(params) for _, params in warehouse.statements] == [255, 255, 85]
+    assert all(len(params) <= app_v2.MAX_QUERY_PARAMETERS for _, params in warehouse.statements)
+    assert len(warehouse.rows) == 119
+
+
+def test_failed_flush_parks_rows_until_a_later_flush(warehouse):
+    warehouse.down = True
+    app_v2._flush_log_batch([_feedback("fb1")])
+    assert warehouse.rows == {}
+    assert _parked_ids() == ["fb1"]
+
+    warehouse.down = False
+    app_v2._flush_log_batch([])
+    assert list(warehouse.rows) == ["fb1"]
+    assert _parked_ids() == []
+
+
+def test_rows_queued_before_sentinel_are_flushed(warehouse):
+    log_queue = queue.Queue()
+    log_queue.put(_feedback("fb1"))
+    log_queue.put(_feedback("fb2"))
+    log_queue.put(None)
+    app_v2._log_worker(log_queue)
+    assert sorted(warehouse.rows) == ["fb1", "fb2"]
+    assert log_queue.empty()
+
+
+def test_feedback_and_snapshot_recover_after_outage(warehouse):
+    warehouse.down = True
+    app_v2._flush_log_batch([_feedback("fb1"), _snapshot("conv1", "hi")])
+    parked_feedback, parked_snapshots = app_v2._load_parked_rows()
+    assert [row['id'] for row in parked_feedback] == ["fb1"]
+    assert [row['id'] for row in parked_snapshots] == ["conv1"]
+
+    warehouse.down = False
+    app_v2._flush_log_batch([])
+    assert sorted(warehouse.rows) == ["conv1", "fb1"]
+    assert _contents(warehouse.rows["conv1"]['message']) == ["hi"]
+    assert _parked_ids() == []
+
+
+def test_newer_snapshot_replaces_parked_one(warehouse):
+    warehouse.down = True
+    app_v2._flush_log_batch([_snapshot("conv1", "hi")])
+    app_v2._flush_log_batch([_snapshot("conv1", "hi", "still there?")])
+    _, parked_snapshots = app_v2._load_parked_rows()
+    assert len(parked_snapshots) == 1
+    assert _contents(parked_snapshots[0]['message']) == ["hi", "still there?"]
+
+    warehouse.down = False
+    app_v2._flush_log_batch([_snapshot("conv1", "hi", "still there?", "hello?")])
+    assert _contents(warehouse.rows["conv1"]['message']) == ["hi", "still there?", "hello?"]
+    assert len(warehouse.statements) == 1
+    assert _parked_ids() == []
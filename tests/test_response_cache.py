@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("streamlit")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_v2  # noqa: E402
+
+
+@pytest.mark.parametrize("text", [
+    "Call me at 555-123-4567",
+    "(555) 123-4567",
+    "+1 555 123 4567",
+    "+1 (555) 123-4567",
+    "I'm at 12 Oak Street",
+    "123 North Main St",
+    "123 Oak Hill Rd",
+])
+def test_job_specific_details_are_detected(text):
+    assert app_v2._RE_JOB_SPECIFIC.search(text)
+
+
+@pytest.mark.parametrize("text", [
+    "What do you charge?",
+    "I need 3 shelves hung in the living room",
+    "My budget is 2000 dollars",
+])
+def test_generic_questions_are_not_flagged(text):
+    assert not app_v2._RE_JOB_SPECIFIC.search(text)
+
+
+def test_history_with_job_specific_details_is_not_cached():
+    history = [app_v2.Msg(role='user', content="Can someone come to 123 Oak Hill Rd?")]
+    assert app_v2._response_cache_key(history) is None
+    assert app_v2._response_cache_key([app_v2.Msg(role='user', content="What do you charge?")]) is not None